@@ -19,7 +19,7 @@ from transformers import (
 
 from multimodal_exp_args import MultimodalDataTrainingArguments, ModelArguments, OurTrainingArguments
 from evaluation import calc_classification_metrics, calc_regression_metrics
-from multimodal_transformers.data import load_data_from_folder, load_data_into_folds
+from multimodal_transformers.data import load_data_from_folder, load_data_into_folds, TorchTabularTextCollator
 from multimodal_transformers.model import TabularConfig
 from multimodal_transformers.model import AutoModelWithTabular
 from util import create_dir_if_not_exists, get_args_info_as_str
@@ -83,6 +83,7 @@ def main():
             sep_text_token_str=tokenizer.sep_token if not data_args.column_info['text_col_sep_token'] else data_args.column_info['text_col_sep_token'],
             max_token_length=training_args.max_token_length,
             debug=training_args.debug_dataset,
+            cache_dir=data_args.data_cache_dir,
         )
         train_datasets = [train_dataset]
         val_datasets = [val_dataset]
@@ -104,6 +105,7 @@ def main():
             data_args.column_info['text_col_sep_token'],
             max_token_length=training_args.max_token_length,
             debug=training_args.debug_dataset,
+            cache_dir=data_args.data_cache_dir,
         )
     train_dataset = train_datasets[0]
 
@@ -160,6 +162,7 @@ def main():
             args=training_args,
             train_dataset=train_dataset,
             eval_dataset=val_dataset,
+            data_collator=TorchTabularTextCollator(tokenizer),
             compute_metrics=build_compute_metrics_fn(task),
         )
         if training_args.do_train:
@@ -50,6 +50,10 @@ class MultimodalDataTrainingArguments:
                                metadata={'help': 'Whether or not we want to create folds for '
                                                  'K fold evaluation of the model'})
 
+    data_cache_dir: Optional[str] = field(default=None,
+                                          metadata={'help': 'Where do you want to cache the tokenized text and preprocessed '
+                                                            'datasets. If not set, the data is preprocessed on every run'})
+
     num_folds: int = field(default=5,
                            metadata={'help': 'The number of folds for K fold '
                                              'evaluation of the model. Will not be used if create_folds is False'})
@@ -1,9 +1,10 @@
 from .load_data import load_data_from_folder, load_data, load_data_into_folds
-from .tabular_torch_dataset import TorchTabularTextDataset
+from .tabular_torch_dataset import TorchTabularTextDataset, TorchTabularTextCollator
 
 __all__ = [
     'load_data',
     'load_data_into_folds',
     'load_data_from_folder',
-    'TorchTabularTextDataset'
+    'TorchTabularTextDataset',
+    'TorchTabularTextCollator'
 ]
\ No newline at end of file
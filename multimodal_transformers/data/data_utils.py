@@ -1,8 +1,15 @@
+import hashlib
+import itertools
+import json
 import logging
-import types
+import os
+from os.path import join, exists
+import tempfile
 
 import numpy as np
+import pandas as pd
 from sklearn import preprocessing
+from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
@@ -34,9 +41,9 @@ class CategoricalFeatures:
         if self.handle_na:
             for c in self.cat_feats:
                 self.df.loc[:, c] = self.df.loc[:, c].astype(str).fillna("-9999999")
-        self.output_df = self.df.copy(deep=True)
 
     def _label_encoding(self):
+        self.output_df = self.df.copy(deep=True)
         for c in self.cat_feats:
             lbl = preprocessing.LabelEncoder()
             lbl.fit(self.df[c].values)
@@ -53,7 +60,7 @@ class CategoricalFeatures:
         for c in self.cat_feats:
             self.df[c] = self.df[c].astype(str)
             classes_orig = self.df[c].unique()
-            val = preprocessing.label_binarize(self.df[c].values, classes=classes_orig)
+            val = preprocessing.label_binarize(self.df[c].values, classes=classes_orig).astype(np.int8)
             vals.append(val)
             if len(classes_orig) == 2:
                 classes = [c + '_binary']
@@ -64,10 +71,27 @@ class CategoricalFeatures:
         return np.concatenate(vals, axis=1)
 
     def _one_hot(self):
-        ohe = preprocessing.OneHotEncoder(sparse=False)
-        ohe.fit(self.df[self.cat_feats].values)
-        self.feat_names = list(ohe.get_feature_names(self.cat_feats))
-        return ohe.transform(self.df[self.cat_feats].values)
+        self.ohe = dict()
+        self.feat_names = []
+        for c in self.cat_feats:
+            if c not in self.ohe:
+                self.ohe[c] = np.unique(self.df[c].astype(str).values)
+            self.feat_names.extend(f'{c}_{x}' for x in self.ohe[c])
+        return self._one_hot_transform(self.df)
+
+    def _one_hot_transform(self, dataframe):
+        """one hot encode dataframe with the fitted categories, unseen categories are all zeros"""
+        vals = []
+        # a column listed more than once in cat_feats is encoded each time like the feature names
+        for c in self.cat_feats:
+            classes = self.ohe[c]
+            col = dataframe[c].astype(str).values
+            codes = np.minimum(np.searchsorted(classes, col), len(classes) - 1)
+            known = np.flatnonzero(classes[codes] == col)
+            val = np.zeros((len(col), len(classes)), dtype=np.int8)
+            val[known, codes[known]] = 1
+            vals.append(val)
+        return np.concatenate(vals, axis=1)
 
     def fit_transform(self):
         if self.enc_type == "label":
@@ -102,50 +126,130 @@ class CategoricalFeatures:
             return dataframe
 
         elif self.enc_type == "ohe":
-            return self.ohe(dataframe[self.cat_feats].values)
+            return self._one_hot_transform(dataframe)
 
         else:
             raise Exception("Encoding type not understood")
 
 
 def normalize_numerical_feats(numerical_feats, transformer=None):
-    if numerical_feats is None or transformer is None:
-        return numerical_feats
-    return transformer.transform(numerical_feats)
+    """transform numerical_feats with transformer if given and cast the result to float32"""
+    if numerical_feats is None:
+        return None
+    if transformer is not None:
+        numerical_feats = transformer.transform(numerical_feats)
+    return numerical_feats.astype(np.float32, copy=False)
 
 
-def convert_to_func(container_arg):
-    """convert container_arg to function that returns True if an element is in container_arg"""
+def convert_to_set(container_arg):
+    """convert container_arg to a frozenset of column names, leaving functions of (df, col) as is"""
     if container_arg is None:
-        return lambda df, x: False
-    if not isinstance(container_arg, types.FunctionType):
-        assert type(container_arg) is list or type(container_arg) is set
-        return lambda df, x: x in container_arg
-    else:
+        return frozenset()
+    if callable(container_arg):
         return container_arg
+    assert isinstance(container_arg, (list, set, frozenset))
+    return frozenset(container_arg)
 
 
-def agg_text_columns_func(empty_row_values, replace_text, texts):
-    """replace empty texts or remove empty text str from a list of text str"""
-    processed_texts = []
-    for text in texts.astype('str'):
-        if text not in empty_row_values:
-            processed_texts.append(text)
-        else:
-            if replace_text is not None:
-                processed_texts.append(replace_text)
-    return processed_texts
+def agg_text_columns_func(empty_row_values, replace_text, texts_df, sep_text):
+    """join the text columns of each row with sep_text, replacing empty texts by
+    replace_text or removing them if replace_text is None"""
+    texts = texts_df.astype('str')
+    is_empty = texts.isin(set(empty_row_values)).to_numpy()
+    texts = texts.to_numpy(dtype=object)
+    if replace_text is not None:
+        texts[is_empty] = replace_text
+        is_empty[:] = False
+
+    joined = np.full(len(texts), '', dtype=object)
+    has_text = np.zeros(len(texts), dtype=bool)
+    for i in range(texts.shape[1]):
+        keep = ~is_empty[:, i]
+        joined[keep] = np.where(has_text[keep], joined[keep] + sep_text, '') + texts[keep, i]
+        has_text |= keep
+    return joined.tolist()
+
+
+def tokenize_text_cols(tokenizer, texts_df, empty_row_values, replace_text, sep_text,
+                       max_token_length=None, cache_dir=None, chunk_size=10000):
+    """aggregate the text columns of texts_df with agg_text_columns_func and tokenize them
+    without padding, chunk_size rows at a time. The result is reused from cache_dir if it
+    was cached there before. Each value of the returned dict is a list of int32 arrays, one per row"""
+    if cache_dir is not None:
+        key = hashlib.blake2b(digest_size=16)
+        key.update(f'{get_tokenizer_signature(tokenizer)}|{max_token_length}|'
+                   f'{sorted(empty_row_values)}|{replace_text}|{sep_text}|'
+                   f'{list(texts_df.columns)}'.encode())
+        key.update(pd.util.hash_pandas_object(texts_df, index=False).values.tobytes())
+        cache_path = join(cache_dir, f'tokenized_{key.hexdigest()}.npz')
+        if exists(cache_path):
+            logger.info(f'Loading tokenized text from {cache_path}')
+            with np.load(cache_path) as cached:
+                flat_encodings = {k: cached[k] for k in cached.files}
+            lengths = flat_encodings.pop('lengths')
+            return split_flat_encodings(flat_encodings, lengths)
+
+    chunk_lengths = []
+    chunk_encodings = {}
+    for start in tqdm(range(0, len(texts_df), chunk_size), desc='Tokenizing text',
+                      disable=len(texts_df) <= chunk_size):
+        texts_list = agg_text_columns_func(empty_row_values, replace_text,
+                                           texts_df.iloc[start:start + chunk_size], sep_text)
+        if start == 0:
+            logger.info(f'Raw text example: {texts_list[0]}')
+        encodings = tokenizer(texts_list, padding=False, truncation=True,
+                              max_length=max_token_length, return_attention_mask=False)
+        lengths = np.fromiter(map(len, encodings['input_ids']), dtype=np.int64,
+                              count=len(encodings['input_ids']))
+        for k, v in encodings.items():
+            chunk_encodings.setdefault(k, []).append(
+                np.fromiter(itertools.chain.from_iterable(v), dtype=np.int32, count=lengths.sum()))
+        chunk_lengths.append(lengths)
+    lengths = np.concatenate(chunk_lengths)
+    flat_encodings = {k: np.concatenate(v) for k, v in chunk_encodings.items()}
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a unique temp file so that concurrent processes writing the same cache do not collide
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.npz.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, lengths=lengths, **flat_encodings)
+        os.replace(tmp_path, cache_path)
+    return split_flat_encodings(flat_encodings, lengths)
+
+
+def get_tokenizer_signature(tokenizer):
+    """hash of the serialized tokenizer identifying it for cache keys"""
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f'{type(tokenizer).__name__}|{tokenizer.name_or_path}|'.encode())
+    if getattr(tokenizer, 'is_fast', False):
+        # includes the vocab, normalizer (e.g. lowercasing), post processor and added tokens,
+        # without the truncation and padding state which changes with each call of the tokenizer
+        serialized = json.loads(tokenizer.backend_tokenizer.to_str())
+        serialized.pop('truncation', None)
+        serialized.pop('padding', None)
+        key.update(json.dumps(serialized, sort_keys=True).encode())
+    else:
+        key.update(repr(sorted(tokenizer.get_vocab().items())).encode())
+        key.update(repr(sorted(tokenizer.init_kwargs.items(), key=lambda kv: kv[0])).encode())
+    return key.hexdigest()
+
+
+def split_flat_encodings(flat_encodings, lengths):
+    """split each concatenated array of flat_encodings into one array per text"""
+    split_indices = np.cumsum(lengths)[:-1]
+    return {k: np.split(v, split_indices) for k, v in flat_encodings.items()}
 
 
-def load_cat_and_num_feats(df, cat_bool_func, num_bool_func, enocde_type=None):
-    cat_feats = load_cat_feats(df, cat_bool_func, enocde_type)
-    num_feats = load_num_feats(df, num_bool_func)
+def load_cat_and_num_feats(df, cat_cols_match, num_cols_match, enocde_type=None, len_train=None):
+    cat_feats = load_cat_feats(df, cat_cols_match, enocde_type)
+    num_feats = load_num_feats(df, num_cols_match, len_train)
     return cat_feats, num_feats
 
 
-def load_cat_feats(df, cat_bool_func, encode_type=None):
+def load_cat_feats(df, cat_cols_match, encode_type=None):
     """load categorical features from DataFrame and do encoding if specified"""
-    cat_cols = get_matching_cols(df, cat_bool_func)
+    cat_cols = get_matching_cols(df, cat_cols_match)
     logger.info(f'{len(cat_cols)} categorical columns')
     if len(cat_cols) == 0:
         return None
@@ -153,16 +257,22 @@ def load_cat_feats(df, cat_bool_func, encode_type=None):
     return cat_feat_processor.fit_transform()
 
 
-def load_num_feats(df, num_bool_func):
-    num_cols = get_matching_cols(df, num_bool_func)
+def load_num_feats(df, num_cols_match, len_train=None):
+    """load numerical features from DataFrame, filling missing values with the medians
+    of the first len_train rows (all rows if None)"""
+    num_cols = get_matching_cols(df, num_cols_match)
     logger.info(f'{len(num_cols)} numerical columns')
-    df = df.copy()
-    df[num_cols] = df[num_cols].astype(float)
-    df[num_cols] = df[num_cols].fillna(dict(df[num_cols].median()), inplace=False)
     if len(num_cols) == 0:
         return None
-    return df[num_cols].values
+    # kept in float64 for fitting the numerical transformer, see normalize_numerical_feats
+    num_feats = df[num_cols].to_numpy(dtype=np.float64, copy=True)
+    nan_rows, nan_cols = np.where(np.isnan(num_feats))
+    num_feats[nan_rows, nan_cols] = np.nanmedian(num_feats[:len_train], axis=0)[nan_cols]
+    return num_feats
 
 
-def get_matching_cols(df, col_match_func):
-    return [c for c in df.columns if col_match_func(df, c)]
\ No newline at end of file
+def get_matching_cols(df, cols_match):
+    """return the columns of df in cols_match, a set of column names or a function of (df, col)"""
+    if callable(cols_match):
+        return [c for c in df.columns if cols_match(df, c)]
+    return [c for c in df.columns if c in cols_match]
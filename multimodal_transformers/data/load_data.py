@@ -1,7 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
 from functools import partial
+import hashlib
 import logging
-from os.path import join, exists
+import os
+from os.path import abspath, dirname, join, exists
+import shutil
+import tempfile
 
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import KFold, train_test_split
 from sklearn.preprocessing import PowerTransformer, QuantileTransformer
@@ -9,16 +16,26 @@ from sklearn.preprocessing import PowerTransformer, QuantileTransformer
 from .tabular_torch_dataset import TorchTabularTextDataset
 from .data_utils import (
     CategoricalFeatures,
-    agg_text_columns_func,
-    convert_to_func,
+    convert_to_set,
     get_matching_cols,
-    load_num_feats,
+    get_tokenizer_signature,
     load_cat_and_num_feats,
     normalize_numerical_feats,
+    split_flat_encodings,
+    tokenize_text_cols,
 )
 
 logger = logging.getLogger(__name__)
 
+SPLITS = ['train', 'val', 'test']
+# pandas' default missing values for csv files, pyarrow's defaults lack 'None' and '<NA>'
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                 '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+# the most rows used to fit the quantile_normal numerical transformer
+QUANTILE_SUBSAMPLE = 200_000
+# bump when the preprocessing or the layout of the cached datasets changes
+DATASETS_CACHE_VERSION = 1
+
 
 def load_data_into_folds(data_csv_path,
                          num_splits,
@@ -35,7 +52,8 @@ def load_data_into_folds(data_csv_path,
                          empty_text_values=None,
                          replace_empty_text=None,
                          max_token_length=None,
-                         debug=False
+                         debug=False,
+                         cache_dir=None
                          ):
     """
         Function to load tabular and text data from a specified folder into folds
@@ -82,6 +100,8 @@ def load_data_into_folds(data_csv_path,
             max_token_length (int, optional): The token length to pad or truncate to on the
                 input text
             debug (bool, optional): Whether or not to load a smaller debug version of the dataset
+            cache_dir (str, optional): The path to a directory in which to cache the
+                tokenized text. If None, the text is tokenized without caching
 
         Returns:
             :obj:`tuple` of `list` of `tabular_torch_dataset.TorchTextDataset`:
@@ -98,10 +118,10 @@ def load_data_into_folds(data_csv_path,
     train_splits, val_splits, test_splits = [], [], []
 
     for train_index, test_index in kfold.split(folds_df):
-        train_df = folds_df.copy().iloc[train_index]
-        test_df = folds_df.copy().iloc[test_index]
+        train_df = folds_df.iloc[train_index]
+        test_df = folds_df.iloc[test_index]
 
-        train, val, test = load_train_val_test_helper(train_df, val_df.copy(),
+        train, val, test = load_train_val_test_helper(train_df, val_df,
                                                       test_df,
                                                       text_cols, tokenizer,
                                                       label_col,
@@ -114,7 +134,8 @@ def load_data_into_folds(data_csv_path,
                                                       empty_text_values,
                                                       replace_empty_text,
                                                       max_token_length,
-                                                      debug)
+                                                      debug,
+                                                      cache_dir)
         train_splits.append(train)
         val_splits.append(val)
         test_splits.append(test)
@@ -136,6 +157,7 @@ def load_data_from_folder(folder_path,
                           replace_empty_text=None,
                           max_token_length=None,
                           debug=False,
+                          cache_dir=None,
                           ):
     """
     Function to load tabular and text data from a specified folder
@@ -144,7 +166,9 @@ def load_data_from_folder(folder_path,
     folder path into TorchTextDataset class and does categorical and numerical
     data preprocessing if specified. Inside the folder, there is expected to be
     a train.csv, and test.csv (and if given val.csv) containing the training, testing,
-    and validation sets respectively
+    and validation sets respectively. If a `.parquet` file exists for a split it is
+    read instead of the `.csv`. Only the text, categorical, numerical and label columns
+    are read from either format.
 
     Args:
         folder_path (str): The path to the folder containing `train.csv`, and `test.csv` (and if given `val.csv`)
@@ -182,6 +206,10 @@ def load_data_from_folder(folder_path,
         max_token_length (int, optional): The token length to pad or truncate to on the
             input text
         debug (bool, optional): Whether or not to load a smaller debug version of the dataset
+        cache_dir (str, optional): The path to a directory in which to cache the
+            tokenized text and the preprocessed datasets. The cached datasets are reused
+            as long as the split files and arguments are unchanged. They are not cached when
+            columns are selected by a function. If None, nothing is cached
 
     Returns:
         :obj:`tuple` of `tabular_torch_dataset.TorchTextDataset`:
@@ -189,23 +217,172 @@ def load_data_from_folder(folder_path,
             training, validation and testing sets. The val dataset is :obj:`None` if
             there is no `val.csv` in folder_path
     """
-    train_df = pd.read_csv(join(folder_path, 'train.csv'), index_col=0)
-    test_df = pd.read_csv(join(folder_path, 'test.csv'), index_col=0)
-    if exists(join(folder_path, 'val.csv')):
-        val_df = pd.read_csv(join(folder_path, 'val.csv'), index_col=0)
+    col_args = [text_cols, categorical_cols, numerical_cols]
+    has_callable_cols = any(callable(cols) for cols in col_args)
+
+    datasets_cache_path = None
+    if cache_dir is not None and has_callable_cols:
+        # the repr of a function changes between runs so it cannot be part of the cache key
+        logger.info('Not caching the preprocessed datasets as columns are selected by a function')
+    elif cache_dir is not None:
+        key = hashlib.blake2b(digest_size=16)
+        key.update(f'{DATASETS_CACHE_VERSION}|'.encode())
+        for split in SPLITS:
+            for ext in ['parquet', 'csv']:
+                path = join(folder_path, f'{split}.{ext}')
+                if exists(path):
+                    stat = os.stat(path)
+                    key.update(f'{abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|'.encode())
+        key.update(repr((text_cols, label_col, label_list, categorical_cols, numerical_cols,
+                         sep_text_token_str, categorical_encode_type, numerical_transformer_method,
+                         empty_text_values, replace_empty_text, max_token_length, debug,
+                         get_tokenizer_signature(tokenizer))).encode())
+        datasets_cache_path = join(cache_dir, f'datasets_{key.hexdigest()}')
+        if exists(datasets_cache_path):
+            logger.info(f'Loading preprocessed datasets from {datasets_cache_path}')
+            return load_cached_datasets(datasets_cache_path, label_list)
+
+    if has_callable_cols:
+        usecols = None
     else:
-        val_df = None
+        usecols = set([label_col]).union(*[cols for cols in col_args if cols is not None])
+
+    splits = ['train', 'test']
+    if exists(join(folder_path, 'val.parquet')) or exists(join(folder_path, 'val.csv')):
+        splits.append('val')
+    with ThreadPoolExecutor(max_workers=len(splits)) as executor:
+        split_dfs = dict(zip(splits, executor.map(partial(read_split_df, folder_path, usecols=usecols),
+                                                  splits)))
+    train_df = split_dfs['train']
+    test_df = split_dfs['test']
+    val_df = split_dfs.get('val')
+
+    datasets = load_train_val_test_helper(train_df, val_df, test_df,
+                                          text_cols, tokenizer, label_col,
+                                          label_list, categorical_cols, numerical_cols,
+                                          sep_text_token_str,
+                                          categorical_encode_type,
+                                          numerical_transformer_method,
+                                          empty_text_values,
+                                          replace_empty_text,
+                                          max_token_length,
+                                          debug,
+                                          cache_dir)
+    if datasets_cache_path is not None:
+        save_cached_datasets(datasets_cache_path, datasets)
+    return datasets
+
+
+def save_cached_datasets(cache_path, datasets):
+    """Save the arrays of the train, val and test datasets as `.npy` files in the cache_path folder.
+    If another process already saved them there, the arrays are discarded"""
+    if exists(cache_path):
+        return
+    cache_dir = dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, suffix='.tmp')
+    for split, dataset in zip(SPLITS, datasets):
+        if dataset is None:
+            continue
+        arrays = {
+            'lengths': np.fromiter(map(len, dataset.encodings['input_ids']), dtype=np.int64,
+                                   count=len(dataset)),
+            'labels': np.asarray(dataset.labels),
+            'categorical_feats': dataset.cat_feats,
+            'numerical_feats': dataset.numerical_feats,
+        }
+        for key, val in dataset.encodings.items():
+            arrays[f'encoding_{key}'] = np.concatenate(val)
+        for name, val in arrays.items():
+            if val is not None:
+                np.save(join(tmp_path, f'{split}_{name}.npy'), val)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if not exists(cache_path):
+            raise
+    if exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+
+def load_cached_datasets(cache_path, label_list=None):
+    """Load the train, val and test datasets saved by :obj:`save_cached_datasets`,
+    memory mapping their arrays"""
+    datasets = []
+    for split in SPLITS:
+        if not exists(join(cache_path, f'{split}_labels.npy')):
+            datasets.append(None)
+            continue
+        arrays = {f[len(split) + 1:-len('.npy')]: np.load(join(cache_path, f), mmap_mode='r')
+                  for f in os.listdir(cache_path) if f.startswith(f'{split}_')}
+        flat_encodings = {key[len('encoding_'):]: val for key, val in arrays.items()
+                          if key.startswith('encoding_')}
+        datasets.append(TorchTabularTextDataset(split_flat_encodings(flat_encodings, arrays['lengths']),
+                                                arrays.get('categorical_feats'),
+                                                arrays.get('numerical_feats'),
+                                                arrays['labels'],
+                                                label_list))
+    return tuple(datasets)
+
+
+def read_split_df(folder_path, split, usecols=None):
+    """Read the `split` DataFrame from folder_path
+
+    Reads `{split}.parquet` if it exists, otherwise `{split}.csv`. For csv files, the
+    first column is used as the index. Both formats are read with the multithreaded
+    pyarrow readers when pyarrow is installed, and the csv falls back to pandas otherwise.
+
+    Args:
+        folder_path (str): The path to the folder containing the split
+        split (str): The name of the split, one of `train`, `val` or `test`
+        usecols (:obj:`set` of :obj:`str`, optional): The columns to read. If None,
+            all columns are read
 
-    return load_train_val_test_helper(train_df, val_df, test_df,
-                                      text_cols, tokenizer, label_col,
-                                      label_list, categorical_cols, numerical_cols,
-                                      sep_text_token_str,
-                                      categorical_encode_type,
-                                      numerical_transformer_method,
-                                      empty_text_values,
-                                      replace_empty_text,
-                                      max_token_length,
-                                      debug)
+    Returns:
+        :obj:`pd.DataFrame`: The DataFrame of the split with columns in file order
+    """
+    parquet_path = join(folder_path, f'{split}.parquet')
+    if exists(parquet_path):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(parquet_path, pre_buffer=True)
+        columns = None
+        if usecols is not None:
+            columns = [c for c in parquet_file.schema_arrow.names if c in usecols]
+        table = parquet_file.read(columns=columns, use_threads=True, use_pandas_metadata=True)
+        return arrow_table_to_df(table)
+
+    csv_path = join(folder_path, f'{split}.csv')
+    try:
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        if usecols is not None:
+            # configured columns missing from the file are ignored like in the pyarrow reader
+            header = pd.read_csv(csv_path, nrows=0).columns
+            usecols = [header[0]] + [c for c in header[1:] if c in usecols]
+        return pd.read_csv(csv_path, index_col=0, usecols=usecols, engine='c', memory_map=True)
+
+    # utf-8-sig strips the byte order mark of csv files exported from Excel
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f))
+    if usecols is not None:
+        header = [header[0]] + [c for c in header[1:] if c in usecols]
+    table = pa_csv.read_csv(csv_path,
+                            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                            convert_options=pa_csv.ConvertOptions(include_columns=header,
+                                                                  null_values=CSV_NA_VALUES,
+                                                                  strings_can_be_null=True,
+                                                                  timestamp_parsers=[]))
+    df = arrow_table_to_df(table).set_index(header[0])
+    df.index.name = header[0] or None
+    return df
+
+
+def arrow_table_to_df(table):
+    """convert a pyarrow Table to a DataFrame with missing strings as nan like pandas' csv reader"""
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    for c in df.columns[df.dtypes == object]:
+        df[c] = df[c].where(df[c].notna(), np.nan)
+    return df
 
 
 def load_train_val_test_helper(train_df,
@@ -223,25 +400,32 @@ def load_train_val_test_helper(train_df,
                                empty_text_values=None,
                                replace_empty_text=None,
                                max_token_length=None,
-                               debug=False):
-    if categorical_encode_type == 'ohe' or categorical_encode_type == 'binary':
-        dfs = [df for df in [train_df, val_df, test_df] if df is not None]
-        data_df = pd.concat(dfs, axis=0)
-        cat_feat_processor = CategoricalFeatures(data_df, categorical_cols, categorical_encode_type)
-        vals = cat_feat_processor.fit_transform()
-        cat_df = pd.DataFrame(vals, columns=cat_feat_processor.feat_names)
-        data_df = pd.concat([data_df, cat_df], axis=1)
-        categorical_cols = cat_feat_processor.feat_names
-
-        len_train = len(train_df)
-        len_val = len(val_df) if val_df is not None else 0
-
-        train_df = data_df.iloc[:len_train]
+                               debug=False,
+                               cache_dir=None):
+    if debug:
+        train_df = train_df[:500]
+        test_df = test_df[:500]
         if val_df is not None:
-            val_df = data_df.iloc[len_train: len_train + len_val]
-            len_train = len_train + len_val
-        test_df = data_df.iloc[len_train:]
+            val_df = val_df[:500]
+
+    dfs = [df for df in [train_df, val_df, test_df] if df is not None]
+    data_df = pd.concat(dfs, axis=0)
+    len_train = len(train_df)
 
+    encoded_cat_feats = None
+    if categorical_encode_type == 'ohe' or categorical_encode_type == 'binary':
+        if categorical_encode_type == 'ohe':
+            # fit the categories on the training rows only, unseen categories are encoded as all zeros
+            cat_feat_processor = CategoricalFeatures(train_df, categorical_cols, categorical_encode_type)
+            vals = np.concatenate([cat_feat_processor.fit_transform(),
+                                   cat_feat_processor.transform(data_df.iloc[len_train:])])
+        else:
+            cat_feat_processor = CategoricalFeatures(data_df, categorical_cols, categorical_encode_type)
+            vals = cat_feat_processor.fit_transform()
+        logger.info(f'{vals.shape[1]} encoded categorical features')
+        # the encoded array is used as is, so the categorical columns are not loaded again
+        encoded_cat_feats = vals
+        categorical_cols = None
         categorical_encode_type = None
 
     if numerical_transformer_method != 'none':
@@ -250,64 +434,57 @@ def load_train_val_test_helper(train_df,
         elif numerical_transformer_method == 'box_cox':
             numerical_transformer = PowerTransformer(method='box-cox')
         elif numerical_transformer_method == 'quantile_normal':
-            numerical_transformer = QuantileTransformer(output_distribution='normal')
+            # cap the rows sorted in fit without raising a lower default of the installed sklearn
+            default_subsample = QuantileTransformer().subsample or QUANTILE_SUBSAMPLE
+            numerical_transformer = QuantileTransformer(output_distribution='normal',
+                                                        n_quantiles=min(len_train, 1000),
+                                                        subsample=min(QUANTILE_SUBSAMPLE,
+                                                                      default_subsample),
+                                                        random_state=0)
         else:
             raise ValueError(f'preprocessing transformer method '
                              f'{numerical_transformer_method} not implemented')
-        num_feats = load_num_feats(train_df, convert_to_func(numerical_cols))
-        numerical_transformer.fit(num_feats)
     else:
         numerical_transformer = None
 
-    train_dataset = load_data(train_df,
-                              text_cols,
-                              tokenizer,
-                              label_col,
-                              label_list,
-                              categorical_cols,
-                              numerical_cols,
-                              sep_text_token_str,
-                              categorical_encode_type,
-                              numerical_transformer,
-                              empty_text_values,
-                              replace_empty_text,
-                              max_token_length,
-                              debug
-                              )
-    test_dataset = load_data(test_df,
-                             text_cols,
-                             tokenizer,
-                             label_col,
-                             label_list,
-                             categorical_cols,
-                             numerical_cols,
-                             sep_text_token_str,
-                             categorical_encode_type,
-                             numerical_transformer,
-                             empty_text_values,
-                             replace_empty_text,
-                             max_token_length,
-                             debug
-                             )
-
-    if val_df is not None:
-        val_dataset = load_data(val_df,
-                                text_cols,
-                                tokenizer,
-                                label_col,
-                                label_list,
-                                categorical_cols,
-                                numerical_cols,
-                                sep_text_token_str,
-                                categorical_encode_type,
-                                numerical_transformer,
-                                empty_text_values,
-                                replace_empty_text,
-                                max_token_length,
-                                debug
-                                )
-    else:
-        val_dataset = None
+    hf_model_text_input, categorical_feats, numerical_feats, labels = load_text_and_tabular_feats(
+        data_df,
+        text_cols,
+        tokenizer,
+        label_col,
+        label_list,
+        categorical_cols,
+        numerical_cols,
+        sep_text_token_str,
+        categorical_encode_type,
+        empty_text_values,
+        replace_empty_text,
+        max_token_length,
+        cache_dir,
+        len_train
+    )
+    if encoded_cat_feats is not None:
+        categorical_feats = encoded_cat_feats
+    if numerical_transformer is not None and numerical_feats is not None:
+        numerical_transformer.fit(numerical_feats[:len_train])
+    numerical_feats = normalize_numerical_feats(numerical_feats, numerical_transformer)
+
+    datasets = []
+    start = 0
+    for df in [train_df, val_df, test_df]:
+        if df is None:
+            datasets.append(None)
+            continue
+        end = start + len(df)
+        datasets.append(TorchTabularTextDataset(
+            {key: val[start:end] for key, val in hf_model_text_input.items()},
+            categorical_feats[start:end] if categorical_feats is not None else None,
+            numerical_feats[start:end] if numerical_feats is not None else None,
+            labels[start:end],
+            label_list
+        ))
+        start = end
+    train_dataset, val_dataset, test_dataset = datasets
 
     return train_dataset, val_dataset, test_dataset
 
@@ -326,6 +503,7 @@ def load_data(data_df,
               replace_empty_text=None,
               max_token_length=None,
               debug=False,
+              cache_dir=None,
               ):
     """Function to load a single dataset given a pandas DataFrame
 
@@ -365,36 +543,89 @@ def load_data(data_df,
         max_token_length (int, optional): The token length to pad or truncate to on the
             input text
         debug (bool, optional): Whether or not to load a smaller debug version of the dataset
+        cache_dir (str, optional): The path to a directory in which to cache the
+            tokenized text. If None, the text is tokenized without caching
 
     Returns:
         :obj:`tabular_torch_dataset.TorchTextDataset`: The converted dataset
     """
     if debug:
         data_df = data_df[:500]
+
+    hf_model_text_input, categorical_feats, numerical_feats, labels = load_text_and_tabular_feats(
+        data_df,
+        text_cols,
+        tokenizer,
+        label_col,
+        label_list,
+        categorical_cols,
+        numerical_cols,
+        sep_text_token_str,
+        categorical_encode_type,
+        empty_text_values,
+        replace_empty_text,
+        max_token_length,
+        cache_dir
+    )
+    numerical_feats = normalize_numerical_feats(numerical_feats, numerical_transformer)
+
+    return TorchTabularTextDataset(hf_model_text_input, categorical_feats,
+                                   numerical_feats, labels, label_list)
+
+
+def load_text_and_tabular_feats(data_df,
+                                text_cols,
+                                tokenizer,
+                                label_col,
+                                label_list=None,
+                                categorical_cols=None,
+                                numerical_cols=None,
+                                sep_text_token_str=' ',
+                                categorical_encode_type='ohe',
+                                empty_text_values=None,
+                                replace_empty_text=None,
+                                max_token_length=None,
+                                cache_dir=None,
+                                len_train=None):
+    """Function to load the tokenized text, tabular features and labels of a DataFrame
+
+    See :obj:`load_data` for a description of the arguments. The numerical features are
+    returned before any normalization so that a transformer can be fit on them, with
+    missing values filled by the medians of the first len_train rows (all rows if None). String
+    labels are encoded as their index in label_list.
+
+    Returns:
+        :obj:`tuple`: The tokenized text (:obj:`dict` of :class:`numpy.ndarray`), the
+        categorical features, the numerical features and the labels
+    """
     if empty_text_values is None:
         empty_text_values = ['nan', 'None']
 
-    text_cols_func = convert_to_func(text_cols)
-    categorical_cols_func = convert_to_func(categorical_cols)
-    numerical_cols_func = convert_to_func(numerical_cols)
+    labels = data_df[label_col].to_numpy()
+    if labels.dtype == object:
+        if label_list is None:
+            raise ValueError(f'label_list is needed to encode the string labels of {label_col}')
+        codes = pd.Categorical(labels, categories=label_list).codes
+        if (codes == -1).any():
+            raise ValueError(f'{label_col} has labels not in label_list: '
+                             f'{sorted(set(labels[codes == -1].tolist()), key=str)}')
+        labels = codes.astype(np.int64)
+
+    text_cols_match = convert_to_set(text_cols)
+    categorical_cols_match = convert_to_set(categorical_cols)
+    numerical_cols_match = convert_to_set(numerical_cols)
 
     categorical_feats, numerical_feats = load_cat_and_num_feats(data_df,
-                                                                categorical_cols_func,
-                                                                numerical_cols_func,
-                                                                categorical_encode_type)
-    numerical_feats = normalize_numerical_feats(numerical_feats, numerical_transformer)
-    agg_func = partial(agg_text_columns_func, empty_text_values, replace_empty_text)
-    texts_cols = get_matching_cols(data_df, text_cols_func)
+                                                                categorical_cols_match,
+                                                                numerical_cols_match,
+                                                                categorical_encode_type,
+                                                                len_train)
+    texts_cols = get_matching_cols(data_df, text_cols_match)
     logger.info(f'Text columns: {texts_cols}')
-    texts_list = data_df[texts_cols].agg(agg_func, axis=1).tolist()
-    for i, text in enumerate(texts_list):
-        texts_list[i] = f' {sep_text_token_str} '.join(text)
-    logger.info(f'Raw text example: {texts_list[0]}')
-    hf_model_text_input = tokenizer(texts_list, padding=True, truncation=True,
-                                    max_length=max_token_length)
-    tokenized_text_ex = ' '.join(tokenizer.convert_ids_to_tokens(hf_model_text_input['input_ids'][0]))
+    hf_model_text_input = tokenize_text_cols(tokenizer, data_df[texts_cols], empty_text_values,
+                                             replace_empty_text, f' {sep_text_token_str} ',
+                                             max_token_length, cache_dir)
+    tokenized_text_ex = ' '.join(tokenizer.convert_ids_to_tokens(hf_model_text_input['input_ids'][0].tolist()))
     logger.debug(f'Tokenized text example: {tokenized_text_ex}')
-    labels = data_df[label_col].values
 
-    return TorchTabularTextDataset(hf_model_text_input, categorical_feats,
-                                   numerical_feats, labels, data_df, label_list)
+    return hf_model_text_input, categorical_feats, numerical_feats, labels
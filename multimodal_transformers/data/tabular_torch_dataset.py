@@ -9,21 +9,19 @@ class TorchTabularTextDataset(TorchDataset):
     and numerical features
 
     Parameters:
-        encodings (:class:`transformers.BatchEncoding`):
-            The output from encode_plus() and batch_encode() methods (tokens, attention_masks, etc) of
-            a transformers.PreTrainedTokenizer
+        encodings (:obj:`dict` of :obj:`list` of :class:`numpy.ndarray`):
+            The unpadded output of a transformers.PreTrainedTokenizer (input_ids, token_type_ids, etc),
+            with one array per example. The text is padded per batch by :obj:`TorchTabularTextCollator`
         categorical_feats (:class:`numpy.ndarray`, of shape :obj:`(n_examples, categorical feat dim)`, `optional`, defaults to :obj:`None`):
             An array containing the preprocessed categorical features
         numerical_feats (:class:`numpy.ndarray`, of shape :obj:`(n_examples, numerical feat dim)`, `optional`, defaults to :obj:`None`):
             An array containing the preprocessed numerical features
         labels (:class: list` or `numpy.ndarray`, `optional`, defaults to :obj:`None`):
             The labels of the training examples
+        label_list (:obj:`list` of :obj:`str`, `optional`, defaults to :obj:`None`):
+            The names of the classes indexed by the labels for classification
         class_weights (:class:`numpy.ndarray`, of shape (n_classes),  `optional`, defaults to :obj:`None`):
             Class weights used for cross entropy loss for classification
-        df (:class:`pandas.DataFrame`, `optional`, defaults to :obj:`None`):
-            Model configuration class with all the parameters of the model.
-            This object must also have a tabular_config member variable that is a
-            TabularConfig instance specifying the configs for TabularFeatCombiner
 
     """
     def __init__(self,
@@ -31,11 +29,9 @@ class TorchTabularTextDataset(TorchDataset):
                  categorical_feats,
                  numerical_feats,
                  labels=None,
-                 df=None,
                  label_list=None,
                  class_weights=None
                  ):
-        self.df = df
         self.encodings = encodings
         self.cat_feats = categorical_feats
         self.numerical_feats = numerical_feats
@@ -59,3 +55,42 @@ class TorchTabularTextDataset(TorchDataset):
     def get_labels(self):
         """returns the label names for classification"""
         return self.label_list
+
+
+class TorchTabularTextCollator:
+    """
+    Collates examples of a :obj:`TorchTabularTextDataset` into a batch, padding the
+    tokenized text to the longest example in the batch and creating its attention mask.
+    To be passed as the data_collator of a :obj:`transformers.Trainer`
+
+    Parameters:
+        tokenizer (:class:`transformers.PreTrainedTokenizer`):
+            The tokenizer used to tokenize the text of the dataset, which specifies
+            the padding values and the padding side
+    """
+    def __init__(self, tokenizer):
+        self.pad_values = {
+            'input_ids': tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0,
+            'token_type_ids': tokenizer.pad_token_type_id
+        }
+        self.padding_side = tokenizer.padding_side
+
+    def __call__(self, examples):
+        lengths = [len(example['input_ids']) for example in examples]
+        max_length = max(lengths)
+        batch = {'attention_mask': torch.zeros((len(examples), max_length), dtype=torch.long)}
+        for key, pad_value in self.pad_values.items():
+            if key in examples[0]:
+                batch[key] = torch.full((len(examples), max_length), pad_value, dtype=torch.long)
+
+        for i, (example, length) in enumerate(zip(examples, lengths)):
+            pos = slice(max_length - length, None) if self.padding_side == 'left' else slice(0, length)
+            batch['attention_mask'][i, pos] = 1
+            for key in self.pad_values:
+                if key in example:
+                    batch[key][i, pos] = example[key]
+
+        for key, val in examples[0].items():
+            if key not in batch and val is not None:
+                batch[key] = torch.stack([example[key] for example in examples])
+        return batch